@@ -2,17 +2,25 @@ import os
 import sys
 import logging
 from flask import Flask, request, jsonify
-from telegram import Bot, Update
-from telegram.ext import Application, CommandHandler, filters, MessageHandler, CallbackQueryHandler
+from telegram import Bot, Update, ChatMember
+from telegram.ext import Application, CommandHandler, filters, MessageHandler, CallbackQueryHandler, ChatMemberHandler
+from telegram.request import HTTPXRequest
 from supabase import create_client, Client
 import requests
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import hmac
 import hashlib
 import json
 import asyncio
 import threading
+import queue
+import sqlite3
+import time
+import traceback
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 # Configurar logging
@@ -35,6 +43,14 @@ NOWPAYMENTS_API_KEY = os.getenv('NOWPAYMENTS_API_KEY')
 NOWPAYMENTS_IPN_SECRET = os.getenv('NOWPAYMENTS_IPN_SECRET')
 GROUP_ID = int(os.getenv('GROUP_ID', -1002877292793))
 PORT = int(os.getenv('PORT', 8080))
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+BOT_MODE = os.getenv('BOT_MODE', 'webhook')  # 'webhook' o 'polling'
+POLLING_BATCH_SIZE = min(max(int(os.getenv('POLLING_BATCH_SIZE', 100)), 1), 100)  # rango de Telegram: 1-100
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 30))
+POLLING_CONCURRENCY = max(int(os.getenv('POLLING_CONCURRENCY', 8)), 1)
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id.strip()}
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))  # segundos
 
 logger.info(f"🚀 Iniciando Ghost Traders Bot")
 logger.info(f"- TELEGRAM_TOKEN: {'✅' if TELEGRAM_TOKEN else '❌'}")
@@ -43,26 +59,390 @@ logger.info(f"- SUPABASE_KEY: {'✅' if SUPABASE_KEY else '❌'}")
 logger.info(f"- NOWPAYMENTS_API_KEY: {'✅' if NOWPAYMENTS_API_KEY else '❌'}")
 logger.info(f"- GROUP_ID: {GROUP_ID}")
 logger.info(f"- PORT: {PORT}")
+logger.info(f"- DATA_DIR: {DATA_DIR}")
+logger.info(f"- BOT_MODE: {BOT_MODE}")
+logger.info(f"- ADMIN_IDS: {len(ADMIN_IDS)} configurados")
+logger.info(f"- ADMIN_TOKEN: {'✅' if ADMIN_TOKEN else '❌'}")
+
+# ============= TRAZAS =============
+
+# Traza del update en curso: {'update_id': ..., 'spans': [(nombre, ms), ...]}
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+@contextmanager
+def trace_span(name):
+    """Medir un tramo dentro de la traza del update actual (sin traza no hace nada)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace['spans'].append((name, (time.perf_counter() - start) * 1000))
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest que registra cada llamada a la API de Telegram como span"""
+    
+    async def do_request(self, url, method, *args, **kwargs):
+        with trace_span(f"telegram.{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+# HTTPXRequest() usa 1 conexión por defecto; ApplicationBuilder usaría 256
+TELEGRAM_POOL_SIZE = max(256, POLLING_CONCURRENCY)
 
 # Inicializar servicios
 try:
-    bot = Bot(TELEGRAM_TOKEN)
+    bot = Bot(TELEGRAM_TOKEN, request=TracedRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
     logger.info("✅ Bot y Supabase inicializados correctamente")
 except Exception as e:
     logger.error(f"❌ Error inicializando servicios: {e}")
     sys.exit(1)
 
+# Catálogo de planes (id -> duración y precio en USD)
+PLANS = {
+    'mensual': {'name': 'Mensual', 'days': 30, 'price': 12},
+    'trimestral': {'name': 'Trimestral', 'days': 90, 'price': 30},
+    'anual': {'name': 'Anual', 'days': 365, 'price': 100},
+}
+DEFAULT_PLAN = 'mensual'
+
 # Variable global para la aplicación
 application = None
+# Event loop del hilo del bot (para programar corrutinas desde Flask)
+bot_loop = None
+# Último latido del event loop (time.monotonic), lo actualiza monitor_loop_lag
+loop_heartbeat = 0.0
+
+# Snapshot local de miembros del grupo, alimentado por updates chat_member
+GROUP_SNAPSHOT_FILE = os.path.join(DATA_DIR, 'group_members.json')
+REMOVAL_DELAY = 0.5  # segundos entre expulsiones (límites de la API de Telegram)
+group_members = set()
+pending_removals = set()
+group_members_lock = threading.Lock()
+group_snapshot_file_lock = threading.Lock()
+# Desde cuándo se registran updates chat_member y si se empezó de cero en este arranque
+group_snapshot_since = None
+group_snapshot_reset = False
+
+# Modo polling
+POLLING_OFFSET_FILE = os.path.join(DATA_DIR, 'polling_offset')
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member']
+
+# Log de eventos (append-only) con rollups diarios por plan
+EVENTS_DB = os.path.join(DATA_DIR, 'events.db')
+EVENT_BATCH_SIZE = 50
+# Eventos del embudo con usuarios distintos por día (daily_rollups.users)
+FUNNEL_EVENTS = ('start', 'invoice_created', 'activation')
+event_queue = queue.Queue()
+# El hilo escritor se arranca con el primer evento (también bajo gunicorn)
+event_writer_thread = None
+event_writer_lock = threading.Lock()
 
 def get_base_url():
     """Obtener la URL base del servidor"""
     return os.getenv('RENDER_EXTERNAL_URL', 'https://ghost-traders-bot.onrender.com')
 
-def create_invoice(user_id, amount=12):
+def is_admin_request():
+    """Comprobar la cabecera X-Admin-Token contra ADMIN_TOKEN (sin token configurado, nadie pasa)"""
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def parse_end_date(end_date_str):
+    """Parsear una fecha de Supabase como datetime con zona horaria (UTC por defecto)"""
+    end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
+    if end_date.tzinfo is None:
+        end_date = end_date.replace(tzinfo=timezone.utc)
+    return end_date
+
+def get_plan_from_order(order_id):
+    """Obtener el plan de un order_id (user_<id>_<plan>_<ts>); órdenes antiguas usan el plan por defecto"""
+    parts = (order_id or '').split('_')
+    if len(parts) >= 4 and parts[2] in PLANS:
+        return parts[2]
+    return DEFAULT_PLAN
+
+def plans_text():
+    """Listado de planes para los mensajes"""
+    return "\n".join(
+        f"• **{plan['name']}**: ${plan['price']} USDT - {plan['days']} días"
+        for plan in PLANS.values()
+    )
+
+def plans_keyboard(user_id):
+    """Botones de pago, uno por plan"""
+    return [
+        [InlineKeyboardButton(
+            f"💰 {plan['name']} - ${plan['price']} USDT",
+            callback_data=f"pay_membership_{plan_id}_{user_id}"
+        )]
+        for plan_id, plan in PLANS.items()
+    ]
+
+def activate_membership(user_id, plan_id, payment_id):
+    """Extender la membresía de forma atómica en Supabase.
+
+    La función extend_membership registra el pago en membership_payments y solo si es
+    nuevo suma los días del plan a max(ahora, fin actual), en una sola sentencia. Un
+    pago repetido (IPN reintentado, "Verificar Pago" antiguo o simultáneo) devuelve la
+    fecha actual, releída en una sentencia aparte.
+    """
+    plan = PLANS[plan_id]
+    with trace_span('supabase.extend_membership'):
+        result = supabase.rpc('extend_membership', {
+            'p_telegram_user_id': user_id,
+            'p_days': plan['days'],
+            'p_payment_id': str(payment_id)
+        }).execute()
+    
+    end_date_str = result.data
+    if end_date_str is None:
+        # Sin fecha devuelta (p. ej. función antigua en carrera con la otra vía): leer la fila
+        membership = fetch_membership(user_id)
+        if not membership.data:
+            raise ValueError(f"extend_membership no devolvió fecha para usuario {user_id}")
+        end_date_str = membership.data[0]['membership_end_date']
+    
+    end_date = parse_end_date(end_date_str)
+    logger.info(f"✅ Membresía de usuario {user_id} extendida ({plan_id}) hasta {end_date.isoformat()}")
+    
+    # Sacarlo de la cola de expulsiones si estaba pendiente
+    with group_members_lock:
+        pending_removals.discard(user_id)
+    record_event('activation', user_id, plan_id, plan['price'], payment_id=payment_id)
+    return end_date
+
+def record_event(event_type, user_id=None, plan=None, amount=None, status=None, payment_id=None):
+    """Encolar un evento para el log (no bloquea; lo escribe el hilo event_writer)"""
+    start_event_writer()
+    event_queue.put((
+        datetime.now(timezone.utc).isoformat(),
+        event_type,
+        user_id,
+        plan or '',
+        amount or 0,
+        status or '',
+        str(payment_id) if payment_id else None
+    ))
+
+def start_event_writer():
+    """Arrancar el hilo event_writer si aún no está en marcha"""
+    global event_writer_thread
+    
+    if event_writer_thread is not None:
+        return
+    with event_writer_lock:
+        if event_writer_thread is None:
+            event_writer_thread = threading.Thread(target=event_writer, daemon=True)
+            event_writer_thread.start()
+
+def init_events_db(conn):
+    """Crear las tablas del log de eventos y de rollups"""
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            telegram_user_id INTEGER,
+            plan TEXT NOT NULL DEFAULT '',
+            amount REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT '',
+            payment_id TEXT
+        );
+        -- Una activación por pago aunque llegue por IPN y por "Verificar Pago"
+        CREATE UNIQUE INDEX IF NOT EXISTS events_activation_payment
+            ON events (payment_id) WHERE event_type = 'activation';
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day TEXT NOT NULL,
+            plan TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan, event_type, status)
+        );
+        -- Usuarios ya contados por día y tipo de evento del embudo
+        CREATE TABLE IF NOT EXISTS daily_users (
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            telegram_user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, event_type, telegram_user_id)
+        );
+    """)
+    
+    # Un evento por (pago, estado): los clics en "Verificar Pago" y los reintentos del IPN
+    # no son cambios de estado. En bases anteriores se quitan antes los duplicados.
+    has_status_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'events_payment_status'"
+    ).fetchone()
+    if not has_status_index:
+        with conn:
+            conn.execute(
+                "DELETE FROM events WHERE event_type = 'payment_status' AND id NOT IN ("
+                "SELECT MIN(id) FROM events WHERE event_type = 'payment_status' GROUP BY payment_id, status)"
+            )
+            conn.execute(
+                "CREATE UNIQUE INDEX events_payment_status "
+                "ON events (payment_id, status) WHERE event_type = 'payment_status'"
+            )
+    
+    # Bases creadas antes de la columna users
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(daily_rollups)")}
+    if 'users' not in columns:
+        conn.execute("ALTER TABLE daily_rollups ADD COLUMN users INTEGER NOT NULL DEFAULT 0")
+
+def write_events(conn, batch):
+    """Insertar un lote de eventos y actualizar los rollups en una sola transacción"""
+    rollups = {}
+    with conn:
+        for event in batch:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO events "
+                "(created_at, event_type, telegram_user_id, plan, amount, status, payment_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                event
+            )
+            if cursor.rowcount == 0:
+                continue
+            created_at, event_type, user_id, plan, amount, status, _ = event
+            day = created_at[:10]
+            
+            new_user = 0
+            if event_type in FUNNEL_EVENTS and user_id is not None:
+                new_user = conn.execute(
+                    "INSERT OR IGNORE INTO daily_users (day, event_type, telegram_user_id) VALUES (?, ?, ?)",
+                    (day, event_type, user_id)
+                ).rowcount
+            
+            key = (day, plan, event_type, status)
+            count, total, users = rollups.get(key, (0, 0, 0))
+            rollups[key] = (count + 1, total + amount, users + new_user)
+        
+        conn.executemany(
+            "INSERT INTO daily_rollups (day, plan, event_type, status, count, amount, users) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (day, plan, event_type, status) DO UPDATE SET "
+            "count = count + excluded.count, amount = amount + excluded.amount, "
+            "users = users + excluded.users",
+            [key + value for key, value in rollups.items()]
+        )
+
+def event_writer():
+    """Hilo que vacía la cola de eventos en SQLite por lotes"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(EVENTS_DB)
+    init_events_db(conn)
+    logger.info(f"📝 Log de eventos en {EVENTS_DB}")
+    
+    while True:
+        batch = [event_queue.get()]
+        while len(batch) < EVENT_BATCH_SIZE:
+            try:
+                batch.append(event_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        try:
+            write_events(conn, batch)
+        except Exception as e:
+            logger.error(f"❌ Error escribiendo {len(batch)} eventos: {e}")
+
+def read_rollups(since_day):
+    """Leer los rollups diarios desde una fecha (YYYY-MM-DD)"""
+    conn = sqlite3.connect(EVENTS_DB)
+    try:
+        init_events_db(conn)
+        return conn.execute(
+            "SELECT day, plan, event_type, status, count, amount, users FROM daily_rollups "
+            "WHERE day >= ? ORDER BY day",
+            (since_day,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+def load_group_snapshot():
+    """Cargar el snapshot de miembros del grupo desde disco"""
+    global group_snapshot_since, group_snapshot_reset
+    
+    try:
+        with open(GROUP_SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+        # Formato anterior: solo la lista de IDs
+        if isinstance(snapshot, list):
+            snapshot = {'since': None, 'members': snapshot}
+        with group_members_lock:
+            group_members.update(snapshot['members'])
+        group_snapshot_since = snapshot.get('since')
+        logger.info(f"👥 Snapshot del grupo cargado: {len(snapshot['members'])} miembros (desde {group_snapshot_since})")
+    except FileNotFoundError:
+        group_snapshot_since = datetime.now(timezone.utc).isoformat()
+        group_snapshot_reset = True
+        logger.warning(f"⚠️ Sin snapshot previo del grupo ({GROUP_SNAPSHOT_FILE}); se empieza de cero. ¿DATA_DIR está en un disco persistente?")
+    except Exception as e:
+        logger.error(f"❌ Error cargando snapshot del grupo: {e}")
+
+def save_group_snapshot():
+    """Guardar el snapshot de miembros del grupo en disco"""
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = GROUP_SNAPSHOT_FILE + '.tmp'
+        # Leer y escribir bajo el mismo lock para que un snapshot viejo no pise a uno nuevo
+        with group_snapshot_file_lock:
+            with group_members_lock:
+                member_ids = sorted(group_members)
+            with open(tmp_path, 'w') as f:
+                json.dump({'since': group_snapshot_since, 'members': member_ids}, f)
+            os.replace(tmp_path, GROUP_SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"❌ Error guardando snapshot del grupo: {e}")
+
+def fetch_active_member_ids(page_size=1000):
+    """Obtener los IDs con membresía activa y vigente (paginado).
+
+    Solo se detiene con una página vacía: si el max-rows de la API es menor que
+    page_size, cada página llega corta y no puede tomarse como la última.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    active_ids = set()
+    offset = 0
+    
+    while True:
+        result = supabase.table('memberships').select('telegram_user_id') \
+            .eq('status', 'active').gt('membership_end_date', now) \
+            .order('telegram_user_id').range(offset, offset + page_size - 1).execute()
+        if not result.data:
+            return active_ids
+        active_ids.update(row['telegram_user_id'] for row in result.data)
+        offset += len(result.data)
+
+def fetch_active_ids_among(user_ids, chunk_size=200):
+    """De una lista de IDs, devolver los que tienen membresía activa y vigente (consulta por lotes)"""
+    now = datetime.now(timezone.utc).isoformat()
+    active_ids = set()
+    user_ids = list(user_ids)
+    
+    for start in range(0, len(user_ids), chunk_size):
+        result = supabase.table('memberships').select('telegram_user_id') \
+            .in_('telegram_user_id', user_ids[start:start + chunk_size]) \
+            .eq('status', 'active').gt('membership_end_date', now).execute()
+        active_ids.update(row['telegram_user_id'] for row in result.data)
+    return active_ids
+
+def fetch_membership(user_id):
+    """Leer la fila de membresía del usuario (bloqueante: llamar con asyncio.to_thread)"""
+    with trace_span('supabase.select_membership'):
+        return supabase.table('memberships').select('*').eq('telegram_user_id', user_id).execute()
+
+def create_invoice(user_id, plan_id=DEFAULT_PLAN):
     """Crear factura en NOWPayments"""
-    logger.info(f"🧾 Creando invoice para usuario {user_id}, monto: ${amount}")
+    plan = PLANS[plan_id]
+    amount = plan['price']
+    logger.info(f"🧾 Creando invoice para usuario {user_id}, plan: {plan_id}, monto: ${amount}")
     
     url = "https://api.nowpayments.io/v1/invoice"
     headers = {
@@ -75,20 +455,22 @@ def create_invoice(user_id, amount=12):
         "price_amount": amount,
         "price_currency": "usd",
         "pay_currency": "usdttrc20",  # USDT TRC20
-        "order_id": f"user_{user_id}_{int(datetime.now().timestamp())}",
-        "order_description": "Ghost Traders - Membresía 30 días",
+        "order_id": f"user_{user_id}_{plan_id}_{int(datetime.now().timestamp())}",
+        "order_description": f"Ghost Traders - Membresía {plan['days']} días",
         "ipn_callback_url": f"{base_url}/webhook/nowpayments",
         "success_url": "https://t.me/ghost_traders_bot?start=success",
         "cancel_url": "https://t.me/ghost_traders_bot?start=cancelled"
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        with trace_span('nowpayments.create_invoice'):
+            response = requests.post(url, headers=headers, json=payload, timeout=10)
         logger.info(f"📡 NOWPayments response: {response.status_code}")
         
         if response.status_code == 201:
             data = response.json()
             logger.info(f"✅ Invoice creado: {data.get('id')}")
+            record_event('invoice_created', user_id, plan_id, amount, payment_id=data.get('id'))
             return data.get('invoice_url'), data.get('id')
         else:
             logger.error(f"❌ Error NOWPayments: {response.text}")
@@ -112,25 +494,20 @@ async def start_command(update: Update, context):
     
     try:
         # Verificar membresía activa
-        result = supabase.table('memberships').select('*').eq('telegram_user_id', user_id).execute()
+        result = await asyncio.to_thread(fetch_membership, user_id)
         
         if result.data:
             membership = result.data[0]
             end_date_str = membership['membership_end_date']
             
-            # Parsear fecha correctamente
-            if end_date_str.endswith('Z'):
-                end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
-            elif '+00:00' in end_date_str:
-                end_date = datetime.fromisoformat(end_date_str)
-            else:
-                end_date = datetime.fromisoformat(end_date_str + '+00:00')
+            end_date = parse_end_date(end_date_str)
             
             if end_date > datetime.now(end_date.tzinfo):
                 # Membresía activa
                 keyboard = InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔗 Unirse al Grupo", callback_data=f"join_group_{user_id}")],
-                    [InlineKeyboardButton("📊 Mi Membresía", callback_data=f"my_membership_{user_id}")]
+                    [InlineKeyboardButton("📊 Mi Membresía", callback_data=f"my_membership_{user_id}")],
+                    [InlineKeyboardButton("🔄 Extender Membresía", callback_data=f"choose_plan_{user_id}")]
                 ])
                 
                 await update.message.reply_text(
@@ -143,17 +520,17 @@ async def start_command(update: Update, context):
                 )
                 return
 
-        # Usuario nuevo o membresía expirada
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💰 Pagar Membresía - $12 USDT", callback_data=f"pay_membership_{user_id}")],
-            [InlineKeyboardButton("ℹ️ Información", callback_data="info")]
-        ])
+        # Usuario nuevo o membresía expirada: entrada del embudo de conversión
+        record_event('start', user_id)
+        keyboard = InlineKeyboardMarkup(
+            plans_keyboard(user_id) +
+            [[InlineKeyboardButton("ℹ️ Información", callback_data="info")]]
+        )
         
         await update.message.reply_text(
             f"¡Bienvenido a Ghost Traders! 👻\n\n"
-            f"🎯 **Plan de Prueba Especial**\n"
-            f"💰 Solo **$12 USDT (TRC20)**\n"
-            f"⏰ Acceso por **30 días**\n\n"
+            f"🎯 **Planes disponibles (USDT TRC20)**\n"
+            f"{plans_text()}\n\n"
             f"🔥 **¿Qué obtienes?**\n"
             f"• Acceso al grupo VIP\n"
             f"• Señales de trading premium\n"
@@ -182,10 +559,14 @@ async def button_callback(update: Update, context):
     await query.answer()
     
     if data.startswith("pay_membership_"):
-        user_id = int(data.split("_")[-1])
+        parts = data.split("_")
+        user_id = int(parts[-1])
+        # Botones antiguos (pay_membership_<id>) no incluyen plan
+        plan_id = parts[2] if len(parts) == 4 and parts[2] in PLANS else DEFAULT_PLAN
+        plan = PLANS[plan_id]
         
         # Crear invoice
-        pay_url, invoice_id = create_invoice(user_id, 12)
+        pay_url, invoice_id = await asyncio.to_thread(create_invoice, user_id, plan_id)
         
         if pay_url and invoice_id:
             keyboard = InlineKeyboardMarkup([
@@ -196,7 +577,8 @@ async def button_callback(update: Update, context):
             
             await query.edit_message_text(
                 f"💳 **Pago Generado**\n\n"
-                f"💰 **Monto**: $12 USDT (TRC20)\n"
+                f"📦 **Plan**: {plan['name']} ({plan['days']} días)\n"
+                f"💰 **Monto**: ${plan['price']} USDT (TRC20)\n"
                 f"📋 **Invoice ID**: `{invoice_id}`\n\n"
                 f"**⚠️ Instrucciones:**\n"
                 f"1. Haz clic en 'Realizar Pago'\n"
@@ -211,7 +593,7 @@ async def button_callback(update: Update, context):
                 "❌ Error generando el enlace de pago.\n"
                 "Intenta de nuevo más tarde.",
                 reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔄 Reintentar", callback_data=f"pay_membership_{user_id}")
+                    InlineKeyboardButton("🔄 Reintentar", callback_data=f"pay_membership_{plan_id}_{user_id}")
                 ]])
             )
     
@@ -223,6 +605,21 @@ async def button_callback(update: Update, context):
         # Verificar estado del pago
         await verify_payment_status(query, user_id, invoice_id)
     
+    elif data.startswith("choose_plan_"):
+        user_id = int(data.split("_")[-1])
+        keyboard = InlineKeyboardMarkup(
+            plans_keyboard(user_id) +
+            [[InlineKeyboardButton("⬅️ Volver", callback_data="back_to_start")]]
+        )
+        
+        await query.edit_message_text(
+            f"🔄 **Extender Membresía**\n\n"
+            f"{plans_text()}\n\n"
+            f"⏰ Los días se suman a tu fecha de expiración actual",
+            reply_markup=keyboard,
+            parse_mode='Markdown'
+        )
+    
     elif data.startswith("join_group_"):
         user_id = int(data.split("_")[-1])
         await generate_group_invite(query, user_id)
@@ -238,8 +635,9 @@ async def button_callback(update: Update, context):
         
         await query.edit_message_text(
             f"📊 **Información del Servicio**\n\n"
-            f"🏷️ **Precio**: $12 USDT (TRC20)\n"
-            f"⏰ **Duración**: 30 días\n"
+            f"🏷️ **Planes**:\n"
+            f"{plans_text()}\n"
+            f"⏰ **Renovación**: los días se suman a tu membresía vigente\n"
             f"💳 **Método de pago**: Crypto (USDT TRC20)\n"
             f"🔒 **Seguro**: Pagos procesados por NOWPayments\n\n"
             f"❓ **¿Dudas?** Contacta: @admin\n",
@@ -259,26 +657,22 @@ async def verify_payment_status(query, user_id, invoice_id):
         url = f"https://api.nowpayments.io/v1/payment/{invoice_id}"
         headers = {"x-api-key": NOWPAYMENTS_API_KEY}
         
-        response = requests.get(url, headers=headers, timeout=10)
+        with trace_span('nowpayments.get_payment'):
+            response = await asyncio.to_thread(requests.get, url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
             status = data.get('payment_status', 'unknown')
             
             logger.info(f"📊 Estado del pago: {status}")
+            record_event('payment_status', user_id, get_plan_from_order(data.get('order_id')),
+                         status=status, payment_id=data.get('payment_id') or invoice_id)
             
             if status == 'finished':
-                # Activar membresía
-                end_date = datetime.now() + timedelta(days=30)
-                
-                supabase.table('memberships').upsert({
-                    'telegram_user_id': user_id,
-                    'membership_end_date': end_date.isoformat(),
-                    'status': 'active',
-                    'payment_id': invoice_id
-                }).execute()
-                
-                logger.info(f"✅ Membresía activada para usuario {user_id}")
+                # Activar membresía (mismo payment_id que el IPN para no duplicar días)
+                plan_id = get_plan_from_order(data.get('order_id'))
+                payment_id = data.get('payment_id') or invoice_id
+                end_date = await asyncio.to_thread(activate_membership, user_id, plan_id, payment_id)
                 
                 keyboard = InlineKeyboardMarkup([[
                     InlineKeyboardButton("🔗 Unirse al Grupo", callback_data=f"join_group_{user_id}")
@@ -310,7 +704,7 @@ async def verify_payment_status(query, user_id, invoice_id):
             
             else:
                 keyboard = InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔄 Reintentar Pago", callback_data=f"pay_membership_{user_id}")
+                    InlineKeyboardButton("🔄 Reintentar Pago", callback_data=f"choose_plan_{user_id}")
                 ]])
                 
                 await query.edit_message_text(
@@ -371,16 +765,13 @@ async def generate_group_invite(query, user_id):
 async def show_membership_info(query, user_id):
     """Mostrar información de la membresía"""
     try:
-        result = supabase.table('memberships').select('*').eq('telegram_user_id', user_id).execute()
+        result = await asyncio.to_thread(fetch_membership, user_id)
         
         if result.data:
             membership = result.data[0]
             end_date_str = membership['membership_end_date']
             
-            if end_date_str.endswith('Z'):
-                end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
-            else:
-                end_date = datetime.fromisoformat(end_date_str + '+00:00')
+            end_date = parse_end_date(end_date_str)
             
             days_left = (end_date - datetime.now(end_date.tzinfo)).days
             
@@ -417,21 +808,19 @@ async def start_command_from_callback(query):
     first_name = user.first_name or "Usuario"
     
     try:
-        result = supabase.table('memberships').select('*').eq('telegram_user_id', user_id).execute()
+        result = await asyncio.to_thread(fetch_membership, user_id)
         
         if result.data:
             membership = result.data[0]
             end_date_str = membership['membership_end_date']
             
-            if end_date_str.endswith('Z'):
-                end_date = datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
-            else:
-                end_date = datetime.fromisoformat(end_date_str + '+00:00')
+            end_date = parse_end_date(end_date_str)
             
             if end_date > datetime.now(end_date.tzinfo):
                 keyboard = InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔗 Unirse al Grupo", callback_data=f"join_group_{user_id}")],
-                    [InlineKeyboardButton("📊 Mi Membresía", callback_data=f"my_membership_{user_id}")]
+                    [InlineKeyboardButton("📊 Mi Membresía", callback_data=f"my_membership_{user_id}")],
+                    [InlineKeyboardButton("🔄 Extender Membresía", callback_data=f"choose_plan_{user_id}")]
                 ])
                 
                 await query.edit_message_text(
@@ -444,16 +833,15 @@ async def start_command_from_callback(query):
                 )
                 return
         
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💰 Pagar Membresía - $12 USDT", callback_data=f"pay_membership_{user_id}")],
-            [InlineKeyboardButton("ℹ️ Información", callback_data="info")]
-        ])
+        keyboard = InlineKeyboardMarkup(
+            plans_keyboard(user_id) +
+            [[InlineKeyboardButton("ℹ️ Información", callback_data="info")]]
+        )
         
         await query.edit_message_text(
             f"¡Bienvenido a Ghost Traders! 👻\n\n"
-            f"🎯 **Plan de Prueba Especial**\n"
-            f"💰 Solo **$12 USDT (TRC20)**\n"
-            f"⏰ Acceso por **30 días**\n\n"
+            f"🎯 **Planes disponibles (USDT TRC20)**\n"
+            f"{plans_text()}\n\n"
             f"🔥 **¿Qué obtienes?**\n"
             f"• Acceso al grupo VIP\n"
             f"• Señales de trading premium\n"
@@ -468,6 +856,148 @@ async def start_command_from_callback(query):
         logger.error(f"❌ Error en start_command_from_callback: {e}")
         await query.edit_message_text("❌ Error interno. Intenta de nuevo.")
 
+async def stats_command(update: Update, context):
+    """Handler del comando /stats [días] (solo administradores)"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.info(f"⛔ /stats denegado a usuario {user_id}")
+        return
+    
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        days = 7
+    days = max(1, min(days, 90))
+    since_day = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    
+    try:
+        rows = await asyncio.to_thread(read_rollups, since_day)
+    except Exception as e:
+        logger.error(f"❌ Error leyendo estadísticas: {e}")
+        await update.message.reply_text("❌ Error obteniendo estadísticas")
+        return
+    
+    per_day = {}
+    per_plan = {}
+    totals = {'start': 0, 'invoice_created': 0, 'activation': 0, 'expiry': 0}
+    # Usuarios distintos por día, sumados sobre el periodo (base de las conversiones)
+    users = {event_type: 0 for event_type in FUNNEL_EVENTS}
+    revenue = 0
+    for day, plan, event_type, status, count, amount, day_users in rows:
+        if event_type not in totals:
+            continue
+        day_stats = per_day.setdefault(day, {'start': 0, 'invoice_created': 0, 'activation': 0, 'expiry': 0, 'revenue': 0})
+        day_stats[event_type] += count
+        totals[event_type] += count
+        if event_type in users:
+            users[event_type] += day_users
+        if event_type == 'activation':
+            day_stats['revenue'] += amount
+            revenue += amount
+            plan_stats = per_plan.setdefault(plan, [0, 0])
+            plan_stats[0] += count
+            plan_stats[1] += amount
+    
+    def rate(numerator, denominator):
+        return (users[numerator] / users[denominator] * 100) if users[denominator] else 0
+    
+    lines = [
+        f"📈 **Estadísticas ({days} días)**\n",
+        f"👤 Inicios sin membresía: **{totals['start']}** ({users['start']} usuarios)",
+        f"🧾 Invoices: **{totals['invoice_created']}** ({users['invoice_created']} usuarios)",
+        f"✅ Activaciones: **{totals['activation']}** ({users['activation']} usuarios)",
+        f"⏰ Expiraciones: **{totals['expiry']}**",
+        f"💰 Ingresos: **${revenue:.2f}**\n",
+        f"🎯 **Conversión** (usuarios distintos por día)",
+        f"• /start → invoice: **{rate('invoice_created', 'start'):.1f}%**",
+        f"• invoice → pago: **{rate('activation', 'invoice_created'):.1f}%**",
+        f"• /start → pago: **{rate('activation', 'start'):.1f}%**\n",
+    ]
+    if per_plan:
+        lines.append("📦 **Por plan**")
+        lines += [
+            f"• {PLANS.get(plan, {}).get('name', plan)}: {count} (${amount:.2f})"
+            for plan, (count, amount) in sorted(per_plan.items())
+        ]
+        lines.append("")
+    if per_day:
+        lines.append("📅 **Por día** (inicios / invoices / activaciones / expiraciones)")
+        lines += [
+            f"• {day}: {d['start']} / {d['invoice_created']} / {d['activation']} / {d['expiry']} (${d['revenue']:.2f})"
+            for day, d in sorted(per_day.items())
+        ]
+    
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+async def track_group_member(update: Update, context):
+    """Actualizar el snapshot del grupo con cada update chat_member"""
+    change = update.chat_member
+    if change.chat.id != GROUP_ID:
+        return
+    
+    new_member = change.new_chat_member
+    user = new_member.user
+    if user.is_bot:
+        return
+    
+    # Administradores y creador no entran en el snapshot: nunca se expulsan
+    is_member = new_member.status == ChatMember.MEMBER or (
+        new_member.status == ChatMember.RESTRICTED and new_member.is_member
+    )
+    
+    with group_members_lock:
+        changed = (user.id in group_members) != is_member
+        if is_member:
+            group_members.add(user.id)
+        else:
+            group_members.discard(user.id)
+    
+    if changed:
+        logger.info(f"👥 Usuario {user.id} {'entró al' if is_member else 'salió del'} grupo ({new_member.status})")
+        await asyncio.to_thread(save_group_snapshot)
+
+async def remove_group_members(user_ids):
+    """Expulsar del grupo a los usuarios sin membresía activa (cola secuencial)"""
+    # Volver a comprobar la cola: alguien pudo pagar entre la lectura de reconcile y el encolado
+    try:
+        paid_ids = await asyncio.to_thread(fetch_active_ids_among, user_ids)
+    except Exception as e:
+        logger.error(f"❌ Error re-verificando membresías, expulsiones canceladas: {e}")
+        with group_members_lock:
+            pending_removals.difference_update(user_ids)
+        return
+    
+    if paid_ids:
+        logger.info(f"⏭️ {len(paid_ids)} usuarios con membresía activa salen de la cola de expulsiones")
+        with group_members_lock:
+            pending_removals.difference_update(paid_ids)
+    
+    removed = 0
+    for user_id in user_ids:
+        # activate_membership lo quita de pending_removals si paga mientras espera
+        with group_members_lock:
+            if user_id not in pending_removals:
+                logger.info(f"⏭️ Usuario {user_id} activó su membresía, no se expulsa")
+                continue
+        
+        try:
+            # ban + unban: lo saca del grupo pero le permite volver tras pagar
+            await bot.ban_chat_member(chat_id=GROUP_ID, user_id=user_id)
+            await bot.unban_chat_member(chat_id=GROUP_ID, user_id=user_id, only_if_banned=True)
+            with group_members_lock:
+                group_members.discard(user_id)
+            removed += 1
+            logger.info(f"🚪 Usuario {user_id} expulsado del grupo (sin membresía activa)")
+        except Exception as e:
+            logger.error(f"❌ Error expulsando usuario {user_id}: {e}")
+        finally:
+            with group_members_lock:
+                pending_removals.discard(user_id)
+        await asyncio.sleep(REMOVAL_DELAY)
+    
+    await asyncio.to_thread(save_group_snapshot)
+    logger.info(f"✅ Expulsiones completadas: {removed}/{len(user_ids)}")
+
 async def handle_message(update: Update, context):
     """Handler para mensajes de texto"""
     await update.message.reply_text(
@@ -509,18 +1039,20 @@ def nowpayments_webhook():
         order_id = data.get('order_id', '')
         payment_id = data.get('payment_id', '')
         
+        if order_id.startswith('user_'):
+            try:
+                record_event('payment_status', int(order_id.split('_')[1]), get_plan_from_order(order_id),
+                             status=payment_status, payment_id=payment_id)
+            except ValueError:
+                logger.error(f"❌ order_id inválido: {order_id}")
+        
         if payment_status == 'finished' and order_id.startswith('user_'):
             try:
                 user_id = int(order_id.split('_')[1])
-                end_date = datetime.now() + timedelta(days=30)
+                plan_id = get_plan_from_order(order_id)
                 
                 # Activar membresía
-                supabase.table('memberships').upsert({
-                    'telegram_user_id': user_id,
-                    'membership_end_date': end_date.isoformat(),
-                    'status': 'active',
-                    'payment_id': payment_id
-                }).execute()
+                activate_membership(user_id, plan_id, payment_id)
                 
                 logger.info(f"✅ Membresía activada automáticamente para usuario {user_id}")
                 
@@ -558,6 +1090,7 @@ async def send_payment_confirmation(user_id):
 @app.route('/webhook/telegram', methods=['POST'])
 def telegram_webhook():
     """Webhook para Telegram"""
+    received_at = time.perf_counter()
     logger.info("📱 Webhook Telegram recibido")
     
     try:
@@ -568,11 +1101,11 @@ def telegram_webhook():
         
         update = Update.de_json(json_data, bot)
         
-        if application:
+        if application and bot_loop:
             # Ejecutar el update en el loop del bot
             asyncio.run_coroutine_threadsafe(
-                application.process_update(update),
-                application.updater.bot._loop if hasattr(application, 'updater') else asyncio.get_event_loop()
+                process_traced_update(update, received_at, time.perf_counter()),
+                bot_loop
             )
         
         return 'ok', 200
@@ -581,6 +1114,114 @@ def telegram_webhook():
         logger.error(f"❌ Error en webhook telegram: {e}")
         return 'error', 500
 
+async def process_traced_update(update, received_at=None, scheduled_at=None, fetched_at=None):
+    """Procesar un update registrando sus spans y loguear el resumen de la traza.
+
+    Webhook: received_at/scheduled_at (time.perf_counter) separan el tiempo en el
+    hilo de Flask ('flask') del tiempo esperando en el event loop ('queue').
+    Polling: fetched_at es cuando llegó el lote; 'batch_wait' es la espera hasta
+    obtener un hueco en el semáforo.
+    """
+    trace = {'update_id': update.update_id, 'spans': []}
+    token = current_trace.set(trace)
+    started_at = time.perf_counter()
+    
+    if received_at is not None and scheduled_at is not None:
+        trace['spans'].append(('flask', (scheduled_at - received_at) * 1000))
+        trace['spans'].append(('queue', (started_at - scheduled_at) * 1000))
+    elif fetched_at is not None:
+        trace['spans'].append(('batch_wait', (started_at - fetched_at) * 1000))
+    
+    try:
+        with trace_span('process_update'):
+            await application.process_update(update)
+    finally:
+        current_trace.reset(token)
+        total_ms = (time.perf_counter() - (received_at or fetched_at or started_at)) * 1000
+        spans = ", ".join(f"{name} {ms:.0f}ms" for name, ms in trace['spans'])
+        logger.info(f"🧭 Traza update {update.update_id}: {total_ms:.0f}ms | {spans}")
+
+async def monitor_loop_lag(interval=0.5):
+    """Medir el retraso del event loop; un retraso alto indica llamadas bloqueantes"""
+    global loop_heartbeat
+    
+    while True:
+        expected = time.monotonic() + interval
+        loop_heartbeat = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - expected
+        loop_heartbeat = time.monotonic()
+        if lag > LOOP_LAG_THRESHOLD:
+            logger.warning(f"🐢 Event loop retrasado {lag * 1000:.0f}ms")
+
+def loop_watchdog(loop_thread_id, interval=0.1):
+    """Hilo que detecta el event loop bloqueado y loguea la pila que lo bloquea"""
+    reported = False
+    
+    while True:
+        time.sleep(interval)
+        stalled = time.monotonic() - loop_heartbeat
+        if loop_heartbeat and stalled > LOOP_LAG_THRESHOLD + 0.5:
+            if not reported:
+                frame = sys._current_frames().get(loop_thread_id)
+                stack = "".join(traceback.format_stack(frame, limit=8)) if frame else "(sin pila)"
+                logger.warning(f"🐢 Event loop bloqueado {stalled * 1000:.0f}ms en:\n{stack}")
+                reported = True
+        else:
+            reported = False
+
+def sample_stacks(seconds, interval):
+    """Muestrear las pilas de todos los hilos y contar las más frecuentes"""
+    own_id = threading.get_ident()
+    samples = Counter()
+    deadline = time.monotonic() + seconds
+    total = 0
+    
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = tuple(
+                f"{os.path.basename(entry.filename)}:{entry.lineno} {entry.name}"
+                for entry in traceback.extract_stack(frame, limit=12)
+            )
+            samples[(names.get(thread_id, str(thread_id)), stack)] += 1
+        total += 1
+        time.sleep(interval)
+    
+    return samples, total
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """Profiler por muestreo bajo demanda (requiere X-Admin-Token)"""
+    if not is_admin_request():
+        return jsonify({"error": "Not found"}), 404
+    
+    try:
+        seconds = min(max(float(request.args.get('seconds', 5)), 0.1), 30)
+        interval = min(max(float(request.args.get('interval', 0.01)), 0.001), 1)
+        top = int(request.args.get('top', 20))
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+    
+    logger.info(f"🔬 Profiling {seconds}s (intervalo {interval}s)")
+    samples, total = sample_stacks(seconds, interval)
+    
+    return jsonify({
+        "seconds": seconds,
+        "samples": total,
+        "stacks": [
+            {
+                "thread": thread_name,
+                "count": count,
+                "percent": round(count / total * 100, 1) if total else 0,
+                "stack": list(stack)
+            }
+            for (thread_name, stack), count in samples.most_common(top)
+        ]
+    }), 200
+
 @app.route('/check_memberships', methods=['GET'])
 def check_memberships():
     """Verificar y limpiar membresías expiradas"""
@@ -601,6 +1242,7 @@ def check_memberships():
                 
                 removed_count += 1
                 logger.info(f"🗑️ Membresía expirada marcada para usuario {user_id}")
+                record_event('expiry', user_id)
                 
                 # Opcionalmente enviar notificación de expiración
                 asyncio.create_task(send_expiration_notice(user_id))
@@ -615,6 +1257,56 @@ def check_memberships():
         logger.error(f"❌ Error checking memberships: {e}")
         return jsonify({"error": "Server error"}), 500
 
+@app.route('/reconcile_members', methods=['GET'])
+def reconcile_members():
+    """Comparar el snapshot del grupo con las membresías activas y encolar expulsiones (requiere X-Admin-Token)"""
+    if not is_admin_request():
+        return jsonify({"error": "Not found"}), 404
+    
+    logger.info("🔍 Reconciliando miembros del grupo")
+    dry_run = request.args.get('dry_run') == '1'
+    
+    try:
+        active_ids = fetch_active_member_ids()
+        
+        with group_members_lock:
+            to_remove = group_members - active_ids - pending_removals
+            if not dry_run:
+                pending_removals.update(to_remove)
+            snapshot_size = len(group_members)
+        
+        if to_remove and not dry_run:
+            if bot_loop:
+                asyncio.run_coroutine_threadsafe(remove_group_members(sorted(to_remove)), bot_loop)
+            else:
+                with group_members_lock:
+                    pending_removals.difference_update(to_remove)
+                logger.error("❌ Bot no inicializado, no se pueden encolar expulsiones")
+                return jsonify({"error": "Bot not ready"}), 503
+        
+        warning = None
+        if group_snapshot_reset:
+            warning = "Snapshot reset on this start (no file in DATA_DIR); members who joined earlier are not tracked"
+        elif snapshot_size == 0:
+            warning = "Snapshot is empty; check chat_member updates and DATA_DIR persistence"
+        if warning:
+            logger.warning(f"⚠️ Reconciliación: {warning}")
+        
+        logger.info(f"✅ Reconciliación: {snapshot_size} en grupo, {len(active_ids)} activos, {len(to_remove)} a expulsar")
+        return jsonify({
+            "status": "dry_run" if dry_run else "queued",
+            "group_members": snapshot_size,
+            "active_memberships": len(active_ids),
+            "to_remove": sorted(to_remove),
+            "snapshot_since": group_snapshot_since,
+            "snapshot_reset": group_snapshot_reset,
+            "warning": warning
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"❌ Error reconciliando miembros: {e}")
+        return jsonify({"error": "Server error"}), 500
+
 async def send_expiration_notice(user_id):
     """Enviar notificación de expiración"""
     try:
@@ -681,12 +1373,15 @@ def setup_application():
     
     try:
         # Crear aplicación
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        application = Application.builder().token(TELEGRAM_TOKEN) \
+            .request(TracedRequest(connection_pool_size=TELEGRAM_POOL_SIZE)).build()
         
         # Agregar handlers
         application.add_handler(CommandHandler('start', start_command))
+        application.add_handler(CommandHandler('stats', stats_command))
         application.add_handler(CallbackQueryHandler(button_callback))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        application.add_handler(ChatMemberHandler(track_group_member, ChatMemberHandler.CHAT_MEMBER))
         
         logger.info("✅ Aplicación de Telegram configurada")
         return True
@@ -695,13 +1390,88 @@ def setup_application():
         logger.error(f"❌ Error configurando aplicación: {e}")
         return False
 
-def run_bot():
-    """Ejecutar el bot en un hilo separado"""
-    logger.info("🚀 Iniciando bot en hilo separado")
+def load_polling_offset():
+    """Leer el último offset de getUpdates confirmado"""
+    try:
+        with open(POLLING_OFFSET_FILE) as f:
+            return int(f.read().strip())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"❌ Error leyendo offset de polling: {e}")
+        return None
+
+def save_polling_offset(offset):
+    """Guardar el offset de getUpdates de forma atómica"""
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = POLLING_OFFSET_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_path, POLLING_OFFSET_FILE)
+    except Exception as e:
+        logger.error(f"❌ Error guardando offset de polling: {e}")
+
+async def poll_updates():
+    """Long-polling con getUpdates: procesa cada lote en paralelo con concurrencia limitada"""
+    webhook_deleted = False
+    offset = load_polling_offset()
+    semaphore = asyncio.Semaphore(POLLING_CONCURRENCY)
+    logger.info(f"🔄 Polling iniciado (offset: {offset}, lote: {POLLING_BATCH_SIZE}, concurrencia: {POLLING_CONCURRENCY})")
+    
+    async def process(update, fetched_at):
+        async with semaphore:
+            try:
+                await process_traced_update(update, fetched_at=fetched_at)
+            except Exception as e:
+                logger.error(f"❌ Error procesando update {update.update_id}: {e}")
+    
+    while True:
+        try:
+            # getUpdates no funciona mientras haya un webhook configurado
+            if not webhook_deleted:
+                await application.bot.delete_webhook()
+                webhook_deleted = True
+                logger.info("✅ Webhook eliminado, usando getUpdates")
+            
+            updates = await application.bot.get_updates(
+                offset=offset,
+                limit=POLLING_BATCH_SIZE,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=ALLOWED_UPDATES
+            )
+        except Exception as e:
+            logger.error(f"❌ Error en {'getUpdates' if webhook_deleted else 'deleteWebhook'}: {e}")
+            await asyncio.sleep(5)
+            continue
+        
+        if not updates:
+            continue
+        
+        logger.info(f"📦 Lote de {len(updates)} updates")
+        fetched_at = time.perf_counter()
+        await asyncio.gather(*(process(update, fetched_at) for update in updates))
+        
+        # Confirmar el lote solo después de procesarlo (al menos una vez)
+        offset = updates[-1].update_id + 1
+        save_polling_offset(offset)
+
+def run_bot(mode=BOT_MODE):
+    """Ejecutar el bot en un hilo separado ('webhook' o 'polling')"""
+    global bot_loop
+    
+    if mode not in ('webhook', 'polling'):
+        logger.warning(f"⚠️ BOT_MODE desconocido '{mode}', se usa 'webhook'")
+        mode = 'webhook'
+    
+    logger.info(f"🚀 Iniciando bot en hilo separado (modo: {mode})")
     
     # Crear nuevo event loop para este hilo
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    bot_loop = loop
+    
+    load_group_snapshot()
     
     # Configurar aplicación
     if not setup_application():
@@ -713,10 +1483,18 @@ def run_bot():
         loop.run_until_complete(application.initialize())
         
         logger.info("✅ Bot inicializado correctamente")
-        logger.info("🔄 Manteniendo loop activo para procesar updates...")
         
-        # Mantener el loop corriendo para procesar updates de webhook
-        loop.run_forever()
+        # Monitoreo de bloqueos del event loop
+        loop.create_task(monitor_loop_lag())
+        threading.Thread(target=loop_watchdog, args=(threading.get_ident(),), daemon=True).start()
+        
+        if mode == 'polling':
+            loop.run_until_complete(poll_updates())
+        else:
+            logger.info("🔄 Manteniendo loop activo para procesar updates...")
+            
+            # Mantener el loop corriendo para procesar updates de webhook
+            loop.run_forever()
         
     except Exception as e:
         logger.error(f"❌ Error ejecutando bot: {e}")
@@ -749,12 +1527,11 @@ if __name__ == '__main__':
         sys.exit(1)
     
     # Iniciar bot en hilo separado
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
+    bot_thread = threading.Thread(target=run_bot, args=(BOT_MODE,), daemon=True)
     bot_thread.start()
     logger.info("✅ Hilo del bot iniciado")
     
     # Esperar un momento para que el bot se inicialice
-    import time
     time.sleep(2)
     
     # Iniciar servidor Flask